@@ -1,37 +1,43 @@
-import glob
+from collections import defaultdict
+from collections.abc import Iterator
 import os
-from pathlib import Path
-import yaml
+import sys
 
-link_map = {}
+import yaml
 
-for path in glob.glob("arcticons-light/scalable/**/*.svg", recursive=True):
-    try:
-        # SYMLINK
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
 
-        icon_source_path = os.readlink(path)
+SCALABLE_ROOT = "arcticons-light/scalable/"
 
-        icon_name = Path(icon_source_path).stem
+link_map = defaultdict(list)
 
-        formatted_path = path.removeprefix("arcticons-light/scalable/").removesuffix(".svg")
 
-        if icon_name not in link_map:
-            link_map[icon_name] = []
+def walk(root: str) -> Iterator[os.DirEntry[str]]:
+    """Yield all SVG files below root, without following symlinked folders."""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk(entry.path)
+            elif entry.name.endswith(".svg"):
+                yield entry
 
-        link_map[icon_name].append(formatted_path)
 
-    except:
-        icon_name = Path(path).stem
+for entry in walk(SCALABLE_ROOT):
+    formatted_path = entry.path[len(SCALABLE_ROOT) :].removesuffix(".svg")
 
-        formatted_path = path.removeprefix("arcticons-light/scalable/").removesuffix(".svg")
+    if entry.is_symlink():
+        icon_name = os.readlink(entry.path).rpartition("/")[2].removesuffix(".svg")
+    else:
+        icon_name = entry.name.removesuffix(".svg")
 
-        if icon_name not in link_map:
-            link_map[icon_name] = []
+    link_map[icon_name].append(formatted_path)
 
-        link_map[icon_name].append(formatted_path)
 
+sorted_link_map = {name: sorted(links) for name, links in sorted(link_map.items())}
 
-for name, links in link_map.items():
-    print(f"{name}:")
-    for link in links:
-        print(f"- {link}")
+sys.stdout.write(
+    yaml.dump(sorted_link_map, Dumper=YamlDumper, default_flow_style=False)
+)
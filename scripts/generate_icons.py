@@ -6,27 +6,45 @@
 from __future__ import annotations
 
 from argparse import ArgumentParser
-from configparser import ConfigParser
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
+from functools import cache
+from itertools import repeat
 import logging
 from logging import getLogger
+import os
 from os import symlink
 from pathlib import Path
 import re
 from shutil import rmtree, which
 import subprocess  # noqa: S404
+import threading
 import tomllib
-from typing import TypedDict
+from typing import NamedTuple, TypedDict
 
 from lxml import etree
 from scour import scour
 import yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 LOGGER = getLogger()
 
 has_inkscape = bool(which("org.inkscape.Inkscape"))
 
-failed_symlinks = []
+workers = os.cpu_count() or 1
+
+# Seconds to wait for Inkscape to start or to finish the actions for an icon.
+inkscape_timeout = 120
+
+failed_symlinks: list[Path] = []
+
+svg_parsers = threading.local()
+
 
 class GeneratorEntry(TypedDict):
     """A config entry for generationg icons."""
@@ -44,156 +62,398 @@ class GeneratorEntry(TypedDict):
 
 type MappingYaml = dict[str, list[str]]
 
+SVG_CIRCLE = "{http://www.w3.org/2000/svg}circle"
+SVG_STYLE = "{http://www.w3.org/2000/svg}style"
 
-def process_entry(
-    entry: str, dests: list[str], destination: Path, config: GeneratorEntry
-) -> None:
-    """Process an entry."""
-    scalable_root = destination / "scalable"
-    symbolic_root = destination / "symbolic"
+RE_STYLE = re.compile(rb"(<style\b[^>]*(?<!/)>)(.*?)(</style>)", re.DOTALL)
+RE_CIRCLE_RADIUS = re.compile(rb"""(<circle\b[^>]*?\sr\s*=\s*)(["'])(?:0?\.75)\2""")
+RE_STROKE_WIDTH = re.compile(r"(stroke-width\s*:)[^;]+;")
+RE_STROKE = re.compile(r"(stroke\s*:[^;]+;)")
+RE_INDEX_THEME_KEY = re.compile(r"^(Name|Comment|Inherits)=.*$", re.MULTILINE)
 
-    if not any((not (scalable_root / (dest + ".svg")).exists()) for dest in dests):
-        logging.info("%s: Skipping, all icons already exist.", entry)
-        return
 
-    dest = dests[0]
+class StyleReplacements(NamedTuple):
+    """The replacements used to restyle the icons of a destination."""
+
+    stroke_width: str
+    stroke: str
+    radius: str
+    circle_radius: bytes
+    src_color: str
+    color: str
 
-    (scalable_root / dest).parent.mkdir(parents=True, exist_ok=True)
+    @classmethod
+    def from_config(cls, config: GeneratorEntry) -> StyleReplacements:
+        """Prepare the replacements for a config entry."""
+        radius = str(0.75 * config["line_weight"])
+        return cls(
+            stroke_width=rf"\g<1>{config['line_weight']}px;",
+            stroke=rf"\1stroke-width:{config['line_weight']}px;",
+            radius=radius,
+            circle_radius=rb"\g<1>\g<2>" + radius.encode() + rb"\g<2>",
+            src_color=config["src_color"],
+            color=config["color"],
+        )
 
-    src_file = None
 
-    for src_dir in config["src_paths"]:
-        src_path = Path(src_dir)
-        if (src_path / f"{entry}.svg").exists():
-            src_file = src_path / f"{entry}.svg"
-            break
+class SymbolicJob(NamedTuple):
+    """A symbolic icon waiting to be exported by Inkscape."""
 
-    if src_file is None:
-        for src_dir in config["src_paths"]:
-            src_path = Path(src_dir)
-            if (src_path / f"{entry.replace('_', '-')}.svg").exists():
-                src_file = src_path / f"{entry.replace('_', '-')}.svg"
-                break
+    src_file: Path
+    scalable_file: Path
+    symbolic_files: list[Path]
 
-    if src_file is None:
-        print(f"\033[91mERROR: {entry} not found!\033[0m")
-        return
 
-    print(f"\033[92m{entry}: {src_file} -> {scalable_root / dest}.svg\033[0m")
+class InkscapeShell:
+    """An Inkscape process running in shell mode.
 
-    svg_file = etree.parse(src_file)  # noqa: S320
-    svg_root = svg_file.getroot()
+    Starting Inkscape takes a lot longer than converting a single icon, so the
+    process is started once and then reused for all icons.
+    """
 
-    circles = svg_root.findall(".//{http://www.w3.org/2000/svg}circle")
-    for circle in circles:
-        if circle.get("r") in {"0.75", ".75"}:
-            circle.set("r", str(0.75 * config["line_weight"]))
+    def __init__(self) -> None:
+        """Create the shell, Inkscape is started on first use."""
+        self._process: asyncio.subprocess.Process | None = None
 
-    style_tag = svg_file.getroot().find(".//{http://www.w3.org/2000/svg}style")
-    if style_tag is None or style_tag.text is None:
-        print(f"\033[91mERROR: {entry} has no style tag!\033[0m")
-        return
+    @staticmethod
+    async def _wait_for_prompt(process: asyncio.subprocess.Process) -> None:
+        """Read the output of Inkscape until it is ready for new commands.
 
-    if "stroke-width" in style_tag.text:
-        style_tag.text = re.sub(
-            r"(stroke-width\s*:)[^;]+;",
-            rf"\g<1>{config["line_weight"]}px;",
-            style_tag.text,
+        Inkscape is killed if it doesn't get ready within inkscape_timeout.
+        """
+        try:
+            _ = await asyncio.wait_for(
+                process.stdout.readuntil(b"> "), inkscape_timeout
+            )
+        except TimeoutError as e:
+            process.kill()
+            raise subprocess.CalledProcessError(
+                await process.wait(), "org.inkscape.Inkscape --shell"
+            ) from e
+        except asyncio.IncompleteReadError as e:
+            raise subprocess.CalledProcessError(
+                await process.wait(), "org.inkscape.Inkscape --shell"
+            ) from e
+
+    async def _start(self) -> asyncio.subprocess.Process:
+        """Start Inkscape if it isn't running."""
+        if self._process is None or self._process.returncode is not None:
+            self._process = await asyncio.create_subprocess_exec(
+                "org.inkscape.Inkscape",
+                "--shell",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+            )
+            await self._wait_for_prompt(self._process)
+        return self._process
+
+    async def export_symbolic(self, src: Path, dst: Path) -> None:
+        """Convert the strokes of src to paths and save the result to dst."""
+        process = await self._start()
+        dst.unlink(missing_ok=True)
+        actions = (
+            f"file-open:{src}; select-all; object-stroke-to-path; "
+            f"export-filename:{dst}; export-overwrite; export-do; file-close"
         )
+        process.stdin.write(f"{actions}\n".encode())
+        await process.stdin.drain()
+        await self._wait_for_prompt(process)
+        if not dst.exists():
+            raise subprocess.CalledProcessError(1, actions)
+
+    async def close(self) -> None:
+        """Quit Inkscape."""
+        if self._process is None or self._process.returncode is not None:
+            return
+        _ = await self._process.communicate(b"quit\n")
+
+
+def restyle_css(style: str, replacements: StyleReplacements) -> str:
+    """Apply the line weight and color to the CSS of an icon."""
+    if "stroke-width" in style:
+        style = RE_STROKE_WIDTH.sub(replacements.stroke_width, style)
     else:
-        style_tag.text = re.sub(
-            r"(stroke\s*:[^;]+;)",
-            rf"\1stroke-width:{config["line_weight"]}px;",
-            style_tag.text,
-        )
+        style = RE_STROKE.sub(replacements.stroke, style)
+    return style.replace(replacements.src_color, replacements.color)
+
+
+def svg_parser() -> etree.XMLPullParser:
+    """Get the SVG parser of the current thread.
 
-    style_tag.text = style_tag.text.replace(config["src_color"], config["color"])
-    svg_file.write(
-        scalable_root / f"{dest}.svg", xml_declaration=True, encoding="UTF-8"
+    Creating a parser sets up a new libxml2 context, so each thread creates one
+    and reuses it for all icons.
+    """
+    parser = getattr(svg_parsers, "parser", None)
+    if parser is None:
+        parser = etree.XMLPullParser(tag=(SVG_CIRCLE, SVG_STYLE))
+        svg_parsers.parser = parser
+    return parser
+
+
+def restyle_svg_tree(svg_data: bytes, replacements: StyleReplacements) -> bytes | None:
+    """Restyle an icon by parsing it as XML.
+
+    Returns None if the icon has no style tag.
+    """
+    parser = svg_parser()
+    try:
+        parser.feed(svg_data)
+        svg_root = parser.close()
+    except etree.XMLSyntaxError:
+        # The parser keeps the events queued before the error, so the next
+        # icon on this thread has to start over with a new one.
+        del svg_parsers.parser
+        raise
+
+    style_tag = None
+    for _, element in parser.read_events():
+        if element.tag == SVG_STYLE:
+            if style_tag is None:
+                style_tag = element
+        elif element.get("r") in {"0.75", ".75"}:
+            element.set("r", replacements.radius)
+
+    if style_tag is None or style_tag.text is None:
+        return None
+
+    style_tag.text = restyle_css(style_tag.text, replacements)
+    return etree.tostring(
+        svg_root.getroottree(), xml_declaration=True, encoding="UTF-8"
     )
 
-    if len(dests) > 1:
-        for dest_file in dests[1:]:
-            (scalable_root / f"{dest_file}.svg").parent.mkdir(
-                parents=True,
-                exist_ok=True,
-            )
-            (scalable_root / f"{dest_file}.svg").unlink(missing_ok=True)
-
-            symlink(
-                (scalable_root / f"{dest}.svg").relative_to(
-                    (scalable_root / f"{dest_file}.svg").parent,
-                    walk_up=True,
-                ),
-                scalable_root / f"{dest_file}.svg",
+
+def restyle_svg(svg_data: bytes, replacements: StyleReplacements) -> bytes | None:
+    """Restyle an icon.
+
+    The icons are small and only a few attributes change, so the data is edited
+    in place instead of parsing and serializing the whole document. Icons with
+    unusual markup fall back to lxml.
+
+    Returns None if the icon has no style tag.
+    """
+    style = RE_STYLE.search(svg_data)
+    if style is None or not style[2]:
+        return restyle_svg_tree(svg_data, replacements)
+
+    css = restyle_css(style[2].decode("utf8"), replacements).encode("utf8")
+    return (
+        RE_CIRCLE_RADIUS.sub(replacements.circle_radius, svg_data[: style.start(2)])
+        + css
+        + RE_CIRCLE_RADIUS.sub(replacements.circle_radius, svg_data[style.end(2) :])
+    )
+
+
+def is_outdated(file: Path, src_mtime: float) -> bool:
+    """Check if a generated file is missing or older than its source."""
+    try:
+        return file.stat().st_mtime < src_mtime
+    except FileNotFoundError:
+        return True
+
+
+def index_src_paths(src_paths: list[str]) -> dict[str, str]:
+    """Map the names of the source icons to their files.
+
+    Icons in earlier source paths take precedence.
+    """
+    src_index: dict[str, str] = {}
+    for src_dir in src_paths:
+        with contextlib.suppress(FileNotFoundError), os.scandir(src_dir) as files:
+            for file in files:
+                if file.name.endswith(".svg") and file.is_file():
+                    src_index.setdefault(file.name.removesuffix(".svg"), file.path)
+    return src_index
+
+
+def write_atomic(file: Path, data: bytes) -> None:
+    """Write a file, without leaving a partially written file on errors."""
+    tmp_file = file.with_name(f"{file.name}.tmp")
+    try:
+        _ = tmp_file.write_bytes(data)
+        _ = tmp_file.replace(file)
+    except BaseException:
+        tmp_file.unlink(missing_ok=True)
+        raise
+
+
+def update_symlink(target: str, link: Path) -> None:
+    """Point link to target, unless it already does."""
+    with contextlib.suppress(OSError):
+        if str(link.readlink()) == target:
+            return
+
+    link.parent.mkdir(parents=True, exist_ok=True)
+    link.unlink(missing_ok=True)
+    symlink(target, link)
+
+
+def process_entry(
+    entry: str,
+    dests: list[str],
+    destination: Path,
+    src_index: dict[str, str],
+    replacements: StyleReplacements,
+) -> SymbolicJob | None:
+    """Process an entry.
+
+    Returns the job to export the symbolic icon if it needs to be updated.
+    """
+    scalable_root = destination / "scalable"
+    symbolic_root = destination / "symbolic"
+
+    scalable_files = [scalable_root / f"{dest}.svg" for dest in dests]
+    symbolic_files = [symbolic_root / f"{dest}-symbolic.svg" for dest in dests]
+    scalable_dst = scalable_files[0]
+
+    src_name = src_index.get(entry) or src_index.get(entry.replace("_", "-"))
+    if src_name is None:
+        print(f"\033[91mERROR: {entry} not found!\033[0m")
+        return None
+
+    src_file = Path(src_name)
+
+    src_mtime = src_file.stat().st_mtime
+    scalable_outdated = any(is_outdated(file, src_mtime) for file in scalable_files)
+    symbolic_outdated = has_inkscape and any(
+        is_outdated(file, src_mtime) for file in symbolic_files
+    )
+
+    if not scalable_outdated and not symbolic_outdated:
+        logging.info("%s: Skipping, all icons are up to date.", entry)
+        return None
+
+    if scalable_outdated:
+        scalable_dst.parent.mkdir(parents=True, exist_ok=True)
+
+        print(f"\033[92m{entry}: {src_file} -> {scalable_dst}\033[0m")
+
+        svg_data = restyle_svg(src_file.read_bytes(), replacements)
+        if svg_data is None:
+            print(f"\033[91mERROR: {entry} has no style tag!\033[0m")
+            return None
+
+        write_atomic(scalable_dst, svg_data)
+
+        for scalable_alt in scalable_files[1:]:
+            update_symlink(
+                os.path.relpath(scalable_dst, scalable_alt.parent), scalable_alt
             )
 
-    if not has_inkscape:
-        return
+    if not symbolic_outdated:
+        return None
+
+    return SymbolicJob(src_file, scalable_dst, symbolic_files)
+
+
+def finish_symbolic(job: SymbolicJob) -> None:
+    """Optimize an exported symbolic icon and link its aliases."""
+    symbolic_dst = job.symbolic_files[0]
+    write_atomic(
+        symbolic_dst,
+        scour.scourString(symbolic_dst.read_text(encoding="utf8")).encode("utf8"),
+    )
+
+    for symbolic_alt in job.symbolic_files[1:]:
+        update_symlink(os.path.relpath(symbolic_dst, symbolic_alt.parent), symbolic_alt)
 
-    (symbolic_root / dest).parent.mkdir(exist_ok=True, parents=True)
 
+async def export_symbolic(
+    job: SymbolicJob, shells: asyncio.Queue[InkscapeShell]
+) -> Path | None:
+    """Export a symbolic icon with the next free Inkscape shell.
+
+    Returns the source file if the export failed.
+    """
+    job.symbolic_files[0].parent.mkdir(exist_ok=True, parents=True)
+
+    shell = await shells.get()
     try:
-        _ = subprocess.run(  # noqa: S603
-            [  # noqa: S607
-                "org.inkscape.Inkscape",
-                "--actions=select-all;object-stroke-to-path",
-                f"--export-filename={symbolic_root / dest}-symbolic.svg",
-                "--export-overwrite",
-                scalable_root / f"{dest}.svg",
-            ],
-            check=True,
-        )
+        await shell.export_symbolic(job.scalable_file, job.symbolic_files[0])
     except subprocess.CalledProcessError as e:
         print(f"\033[91m{e}\033[0m")
-        failed_symlinks.append(src_file)
-
-    with (symbolic_root / f"{dest}-symbolic.svg").open("r+") as symbolic_file:
-        svg_data = scour.scourString(symbolic_file.read())
-        symbolic_file.seek(0)
-        symbolic_file.truncate()
-        symbolic_file.write(svg_data)
-
-    # remove .0.svg files in case of inkscape crashing
-    for file in scalable_root.glob(f"{dest}*.0.svg"):
-        file.unlink()
-
-    if len(dests) > 1:
-        for dest_file in dests[1:]:
-            (symbolic_root / f"{dest_file}-symbolic.svg").parent.mkdir(
-                parents=True,
-                exist_ok=True,
-            )
-            (symbolic_root / f"{dest_file}-symbolic.svg").unlink(missing_ok=True)
-
-            symlink(
-                (symbolic_root / f"{dest}-symbolic.svg").relative_to(
-                    (symbolic_root / f"{dest_file}-symbolic.svg").parent,
-                    walk_up=True,
-                ),
-                symbolic_root / f"{dest_file}-symbolic.svg",
-            )
+        return job.src_file
+    finally:
+        shells.put_nowait(shell)
+
+    await asyncio.to_thread(finish_symbolic, job)
+    return None
+
+
+async def export_symbolic_icons(jobs: list[SymbolicJob]) -> list[Path]:
+    """Export all symbolic icons, one Inkscape shell per worker.
+
+    Returns the source files of the failed exports.
+    """
+    shells: asyncio.Queue[InkscapeShell] = asyncio.Queue()
+    for _ in range(min(workers, len(jobs))):
+        shells.put_nowait(InkscapeShell())
+
+    try:
+        failed_srcs = await asyncio.gather(
+            *(export_symbolic(job, shells) for job in jobs)
+        )
+    finally:
+        while not shells.empty():
+            await shells.get_nowait().close()
+
+    return [failed_src for failed_src in failed_srcs if failed_src is not None]
 
 
 def generate_destination(
     destination: Path, config: GeneratorEntry, mapping_yaml: MappingYaml
 ) -> None:
     """Generate the icons in the destination."""
-    for entry, dests in mapping_yaml.items():
-        process_entry(entry, dests, destination, config)
+    # The thread pool overlaps reading and writing the icon files, the regex
+    # work itself still holds the GIL.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [
+            job
+            for job in executor.map(
+                process_entry,
+                mapping_yaml.keys(),
+                mapping_yaml.values(),
+                repeat(destination),
+                repeat(index_src_paths(config["src_paths"])),
+                repeat(StyleReplacements.from_config(config)),
+            )
+            if job is not None
+        ]
+
+    failed_symlinks.extend(asyncio.run(export_symbolic_icons(jobs)))
+
+    # remove .0.svg files in case of inkscape crashing, but keep icons which are
+    # named like that on purpose, e.g. "apps/blender-3.0"
+    icon_files = {
+        destination / "scalable" / f"{dest}.svg"
+        for dests in mapping_yaml.values()
+        for dest in dests
+    }
+    for job in jobs:
+        for file in job.scalable_file.parent.glob(f"{job.scalable_file.stem}*.0.svg"):
+            if file not in icon_files:
+                file.unlink()
+
+
+@cache
+def index_theme_template() -> str:
+    """Read the index.theme file used as template."""
+    return Path("index.theme").read_text(encoding="utf8")
 
 
 def generate_index_theme(destination: Path, config: GeneratorEntry) -> None:
     """Generate the target index.theme file."""
 
-    index_theme_file = ConfigParser()
-    index_theme_file.optionxform = lambda optionstr: optionstr
-    _ = index_theme_file.read("index.theme")
-    index_theme_file["Icon Theme"]["Name"] = config["name"]
-    index_theme_file["Icon Theme"]["Comment"] = config["comment"]
-    index_theme_file["Icon Theme"]["Inherits"] = config["inherits"]
-    with (destination / "index.theme").open("w", encoding="utf8") as dest_fp:
-        index_theme_file.write(dest_fp, space_around_delimiters=False)
+    values = {
+        "Name": config["name"],
+        "Comment": config["comment"],
+        "Inherits": config["inherits"],
+    }
+    (destination / "index.theme").write_text(
+        RE_INDEX_THEME_KEY.sub(
+            lambda key: f"{key[1]}={values[key[1]]}", index_theme_template()
+        ),
+        encoding="utf8",
+    )
 
 
 def main(config_file: Path) -> None:
@@ -207,7 +467,7 @@ def main(config_file: Path) -> None:
     )
 
     with Path("mapping.yaml").open(encoding="utf8") as yaml_fp:
-        mapping_yaml: MappingYaml = yaml.safe_load(yaml_fp)
+        mapping_yaml: MappingYaml = yaml.load(yaml_fp, Loader=YamlLoader)
 
     for section, entry in config.items():
         if entry["overwrite"]:
@@ -8,6 +8,11 @@ import sys
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 LOGGER = logging.getLogger()
 
 
@@ -16,7 +21,7 @@ def validate_mapping(file: Path, *, fix: bool = False) -> bool:
     valid = True
 
     with file.open(encoding="utf8") as yaml_fp:
-        yaml_doc: dict[str, list[str]] = yaml.safe_load(yaml_fp)
+        yaml_doc: dict[str, list[str]] = yaml.load(yaml_fp, Loader=YamlLoader)
 
         yaml_fp.seek(0, 0)
         yaml_lines = yaml_fp.readlines()